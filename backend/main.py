@@ -1,15 +1,24 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 import uvicorn
+import aiofiles
+import asyncio
+import hashlib
 import os
-import shutil
 import uuid
 import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from datetime import datetime
+from functools import lru_cache
 from typing import Optional
 from pydantic import BaseModel
+from starlette.formparsers import MultiPartParser
 
 from table_extractor import TableExtractor
 
@@ -20,11 +29,83 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+# 表格提取器（每个进程在首次使用时初始化，避免导入时加载 OCR 模型）。
+# 只在 OCR 进程池中使用：并行由进程池提供，每个进程只用单线程推理，
+# 避免进程数 × 推理线程数远超 CPU 核数
+@lru_cache(maxsize=1)
+def get_extractor() -> TableExtractor:
+    return TableExtractor(use_gpu=False, cpu_threads=1)
+
+
+# 以下函数在 OCR 进程池中执行
+def _init_ocr():
+    get_extractor()
+
+
+def _do_extract(file_path: str) -> dict:
+    return get_extractor().extract_table_data(file_path)
+
+
+def create_ocr_pool() -> ProcessPoolExecutor:
+    """
+    创建 OCR 进程池
+
+    使用 spawn 启动子进程，避免在事件循环线程和 anyio 工作线程存活时 fork
+    """
+    return ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_ocr
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # OCR 在独立进程中运行，不受 GIL 限制，可以利用多核并行处理
+    app.state.pool = create_ocr_pool()
+    try:
+        yield
+    finally:
+        app.state.pool.shutdown()
+
+
+async def run_in_pool(request: Request, func, *args):
+    """
+    在 OCR 进程池中执行函数
+
+    工作进程异常退出（如被 OOM 终止）会导致整个进程池不可用，
+    此时重建进程池并重试一次，仍然失败则返回 503
+    """
+    loop = asyncio.get_running_loop()
+    state = request.app.state
+
+    pool = state.pool
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        logger.error("OCR 进程池已损坏，正在重建")
+        # 并发请求可能已经重建过进程池
+        if state.pool is pool:
+            state.pool = create_ocr_pool()
+            pool.shutdown(wait=False)
+
+    try:
+        return await loop.run_in_executor(state.pool, func, *args)
+    except BrokenProcessPool:
+        logger.error("重建后的 OCR 进程池仍不可用")
+        raise HTTPException(
+            status_code=503,
+            detail="OCR 服务暂时不可用，请稍后重试"
+        )
+
+
 # 创建应用
 app = FastAPI(
     title="表格图片识别转换 API",
     description="将图片中的表格转换为 Excel 文件",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # 配置 CORS
@@ -36,6 +117,35 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 上传/下载的读写缓冲区大小（1 MiB）
+IO_CHUNK_SIZE = 1024 * 1024
+
+# 上传文件在内存中缓存的上限（10 MiB），常见图片不会先写入临时文件再复制。
+# starlette 0.46 起该属性名为 spool_max_size，之前的版本为 max_file_size
+UPLOAD_SPOOL_MAX_SIZE = 10 * 1024 * 1024
+if hasattr(MultiPartParser, "spool_max_size"):
+    MultiPartParser.spool_max_size = UPLOAD_SPOOL_MAX_SIZE
+elif hasattr(MultiPartParser, "max_file_size"):
+    MultiPartParser.max_file_size = UPLOAD_SPOOL_MAX_SIZE
+else:
+    raise RuntimeError("无法设置上传文件的内存缓存上限：不支持当前 starlette 版本的 MultiPartParser")
+
+# 识别结果缓存（按图像内容哈希，保存在 Web 进程中以便所有 OCR 工作进程共享）
+RESULT_CACHE_SIZE = 64
+_result_cache: "OrderedDict[str, dict]" = OrderedDict()
+
+
+def _file_digest(file_path: str) -> str:
+    """
+    计算文件内容哈希
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(IO_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 # 创建必要的目录
 UPLOAD_DIR = "uploads"
 OUTPUT_DIR = "outputs"
@@ -45,8 +155,15 @@ os.makedirs(OUTPUT_DIR, exist_ok=True)
 # 挂载静态文件目录（用于前端访问生成的文件）
 app.mount("/outputs", StaticFiles(directory=OUTPUT_DIR), name="outputs")
 
-# 初始化表格提取器
-extractor = TableExtractor(use_gpu=False)
+
+class ExcelFileResponse(FileResponse):
+    """
+    Excel 文件响应
+
+    服务器支持 http.response.pathsend 扩展时由服务器零拷贝发送文件，
+    否则按 1 MiB 分块读取，减少线程切换和系统调用次数。
+    """
+    chunk_size = IO_CHUNK_SIZE
 
 
 # 数据模型
@@ -107,13 +224,14 @@ async def upload_image(file: UploadFile = File(...)):
         file_path = os.path.join(UPLOAD_DIR, filename)
 
         # 保存文件
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        async with aiofiles.open(file_path, "wb") as buffer:
+            while chunk := await file.read(IO_CHUNK_SIZE):
+                await buffer.write(chunk)
 
         logger.info(f"文件上传成功: {filename}")
 
-        # 验证图像
-        if not extractor.validate_image(file_path):
+        # 验证图像（只用到 OpenCV，不需要 OCR 模型，在线程中执行，避免排在 OCR 任务之后）
+        if not await asyncio.to_thread(TableExtractor.validate_image, file_path):
             os.remove(file_path)
             raise HTTPException(
                 status_code=400,
@@ -140,7 +258,7 @@ async def upload_image(file: UploadFile = File(...)):
 
 # 处理图像并提取表格
 @app.post("/process")
-async def process_image(file_id: str, filename: str):
+async def process_image(request: Request, file_id: str, filename: str):
     """
     处理上传的图片，提取表格并生成 Excel
     """
@@ -156,8 +274,23 @@ async def process_image(file_id: str, filename: str):
 
         logger.info(f"开始处理文件: {filename}")
 
-        # 提取表格数据
-        result = extractor.extract_table_data(file_path)
+        # 相同内容的图像直接使用缓存结果。
+        # 注意：命中时 excel_path 和 debug_image 属于此前上传的同内容图像，
+        # 返回的下载链接指向那次生成的 Excel 文件
+        digest = await asyncio.to_thread(_file_digest, file_path)
+        result = _result_cache.get(digest)
+        if result is not None and os.path.exists(result['excel_path']):
+            _result_cache.move_to_end(digest)
+            logger.info(f"命中识别结果缓存: {filename}")
+        else:
+            # 提取表格数据
+            result = await run_in_pool(request, _do_extract, file_path)
+
+            # 缓存成功的结果，超出容量时淘汰最久未使用的条目
+            if result['success']:
+                _result_cache[digest] = result
+                if len(_result_cache) > RESULT_CACHE_SIZE:
+                    _result_cache.popitem(last=False)
 
         if not result['success']:
             raise HTTPException(
@@ -169,12 +302,16 @@ async def process_image(file_id: str, filename: str):
         excel_filename = os.path.basename(result['excel_path'])
         excel_url = f"/outputs/{excel_filename}"
 
-        # 准备预览数据（前5行）
-        preview_data = result['table_data'][:5] if result['table_data'] else []
+        # 准备预览数据（前5行），短行补齐到相同列数
+        col_count = result['col_count']
+        preview_data = [
+            row + [''] * (col_count - len(row))
+            for row in result['table_data'][:5]
+        ]
 
         # 清理临时文件（可选）
         # os.remove(file_path)
-        # if 'debug_image' in result and os.path.exists(result['debug_image']):
+        # if result.get('debug_image') and os.path.exists(result['debug_image']):
         #     os.remove(result['debug_image'])
 
         return ProcessResult(
@@ -198,37 +335,42 @@ async def process_image(file_id: str, filename: str):
 
 # 批量处理
 @app.post("/batch-process")
-async def batch_process(files: list[UploadFile] = File(...)):
+async def batch_process(request: Request, files: list[UploadFile] = File(...)):
     """
     批量处理多个图片文件
     """
-    results = []
-
-    for file in files:
-        try:
-            # 上传文件
-            upload_result = await upload_image(file)
-
-            # 处理文件
-            process_result = await process_image(
-                upload_result['file_id'],
-                upload_result['filename']
-            )
-
-            results.append({
-                "filename": file.filename,
-                "success": True,
-                "excel_url": process_result.excel_url,
-                "row_count": process_result.row_count,
-                "col_count": process_result.col_count
-            })
-
-        except Exception as e:
-            results.append({
-                "filename": file.filename,
-                "success": False,
-                "error": str(e)
-            })
+    # 限制并发数，避免多个 OCR 任务争抢 CPU
+    semaphore = asyncio.Semaphore(os.cpu_count() or 1)
+
+    async def _handle(file: UploadFile) -> dict:
+        async with semaphore:
+            try:
+                # 上传文件
+                upload_result = await upload_image(file)
+
+                # 处理文件
+                process_result = await process_image(
+                    request,
+                    upload_result['file_id'],
+                    upload_result['filename']
+                )
+
+                return {
+                    "filename": file.filename,
+                    "success": True,
+                    "excel_url": process_result.excel_url,
+                    "row_count": process_result.row_count,
+                    "col_count": process_result.col_count
+                }
+
+            except Exception as e:
+                return {
+                    "filename": file.filename,
+                    "success": False,
+                    "error": str(e)
+                }
+
+    results = await asyncio.gather(*(_handle(f) for f in files))
 
     return {
         "total": len(files),
@@ -246,16 +388,16 @@ async def list_files():
     """
     try:
         files = []
-        for filename in os.listdir(OUTPUT_DIR):
-            if filename.endswith('.xlsx'):
-                file_path = os.path.join(OUTPUT_DIR, filename)
-                stat = os.stat(file_path)
-                files.append({
-                    "filename": filename,
-                    "url": f"/outputs/{filename}",
-                    "size": stat.st_size,
-                    "created": datetime.fromtimestamp(stat.st_ctime).isoformat()
-                })
+        with os.scandir(OUTPUT_DIR) as entries:
+            for entry in entries:
+                if entry.name.endswith('.xlsx'):
+                    stat = entry.stat()
+                    files.append({
+                        "filename": entry.name,
+                        "url": f"/outputs/{entry.name}",
+                        "size": stat.st_size,
+                        "created": datetime.fromtimestamp(stat.st_ctime).isoformat()
+                    })
 
         return {
             "success": True,
@@ -285,7 +427,7 @@ async def download_file(filename: str):
             detail="文件不存在"
         )
 
-    return FileResponse(
+    return ExcelFileResponse(
         file_path,
         filename=filename,
         media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
@@ -303,20 +445,18 @@ async def cleanup_files(days_old: int = 7):
         now = datetime.now().timestamp()
 
         # 清理上传目录
-        for filename in os.listdir(UPLOAD_DIR):
-            file_path = os.path.join(UPLOAD_DIR, filename)
-            stat = os.stat(file_path)
-            if (now - stat.st_mtime) > (days_old * 86400):
-                os.remove(file_path)
-                deleted_count += 1
+        with os.scandir(UPLOAD_DIR) as entries:
+            for entry in entries:
+                if (now - entry.stat().st_mtime) > (days_old * 86400):
+                    os.remove(entry.path)
+                    deleted_count += 1
 
         # 清理输出目录
-        for filename in os.listdir(OUTPUT_DIR):
-            file_path = os.path.join(OUTPUT_DIR, filename)
-            stat = os.stat(file_path)
-            if (now - stat.st_mtime) > (days_old * 86400):
-                os.remove(file_path)
-                deleted_count += 1
+        with os.scandir(OUTPUT_DIR) as entries:
+            for entry in entries:
+                if (now - entry.stat().st_mtime) > (days_old * 86400):
+                    os.remove(entry.path)
+                    deleted_count += 1
 
         return {
             "success": True,
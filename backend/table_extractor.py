@@ -1,6 +1,7 @@
 import cv2
 import numpy as np
-import pandas as pd
+import xlsxwriter
+from PIL import Image
 from paddleocr import PaddleOCR
 import logging
 import os
@@ -11,23 +12,47 @@ import json
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Excel 文件写入缓冲区大小（1 MiB）
+EXCEL_WRITE_BUFFER_SIZE = 1024 * 1024
+
+# 模糊度检测的工作尺寸（长边像素数）和原始分辨率下的拉普拉斯方差阈值
+BLUR_CHECK_SIZE = 1024
+BLUR_THRESHOLD = 100
+# 阈值换算时缩小倍数的上限
+BLUR_MAX_SHRINK = 4
+
+# 解码时可直接缩小的倍数，从大到小
+REDUCED_GRAYSCALE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+
 
 class TableExtractor:
     """表格提取器"""
 
-    def __init__(self, use_gpu: bool = False):
+    def __init__(self, use_gpu: bool = False, heavy_denoise: bool = False,
+                 debug: bool = False, cpu_threads: int = 10):
         """
         初始化 OCR 引擎
 
         Args:
             use_gpu: 是否使用 GPU
+            heavy_denoise: 是否使用非局部均值降噪（效果更好但速度很慢）
+            debug: 是否保存预处理后的图像用于调试
+            cpu_threads: CPU 推理使用的线程数
         """
+        self.heavy_denoise = heavy_denoise
+        self.debug = debug
+
         try:
             self.ocr = PaddleOCR(
                 use_angle_cls=True,
                 lang='ch',
                 table=True,  # 启用表格识别
                 use_gpu=use_gpu,
+                cpu_threads=cpu_threads,
                 show_log=False,
                 det_db_box_thresh=0.5,
                 det_db_unclip_ratio=1.6,
@@ -39,6 +64,9 @@ class TableExtractor:
             logger.error(f"PaddleOCR 初始化失败: {e}")
             raise
 
+        # 对比度增强器，所有请求复用同一个实例
+        self._clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+
     def preprocess_image(self, image_path: str) -> np.ndarray:
         """
         图像预处理
@@ -49,24 +77,21 @@ class TableExtractor:
         Returns:
             预处理后的图像
         """
+        gray = None
         try:
-            # 读取图像
-            img = cv2.imread(image_path)
-            if img is None:
+            # 直接以灰度图读取图像
+            gray = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+            if gray is None:
                 raise ValueError("无法读取图像文件")
 
-            # 转为灰度图
-            if len(img.shape) == 3:
-                gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            else:
-                gray = img
-
             # 增强对比度
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-            enhanced = clahe.apply(gray)
+            enhanced = self._clahe.apply(gray)
 
             # 降噪
-            denoised = cv2.fastNlMeansDenoising(enhanced)
+            if self.heavy_denoise:
+                denoised = cv2.fastNlMeansDenoising(enhanced)
+            else:
+                denoised = cv2.medianBlur(enhanced, 3)
 
             # 二值化
             _, binary = cv2.threshold(
@@ -78,9 +103,10 @@ class TableExtractor:
 
         except Exception as e:
             logger.error(f"图像预处理失败: {e}")
-            # 如果预处理失败，返回原始图像
-            img = cv2.imread(image_path)
-            return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            # 如果预处理失败，返回已读取的灰度图，无需再次读取文件
+            if gray is None:
+                raise
+            return gray
 
     def extract_table_data(self, image_path: str) -> dict:
         """
@@ -98,10 +124,12 @@ class TableExtractor:
             # 1. 图像预处理
             processed_img = self.preprocess_image(image_path)
 
-            # 2. 保存预处理后的图像（用于调试）
-            debug_path = image_path.replace('.', '_processed.')
-            cv2.imwrite(debug_path, processed_img)
-            logger.info(f"预处理图像已保存: {debug_path}")
+            # 2. 保存预处理后的图像（仅调试模式）
+            debug_path = None
+            if self.debug:
+                debug_path = image_path.replace('.', '_processed.')
+                cv2.imwrite(debug_path, processed_img)
+                logger.info(f"预处理图像已保存: {debug_path}")
 
             # 3. OCR 识别
             logger.info("正在执行 OCR 识别...")
@@ -121,7 +149,7 @@ class TableExtractor:
                 'excel_path': excel_path,
                 'debug_image': debug_path,
                 'row_count': len(table_data),
-                'col_count': len(table_data[0]) if table_data else 0
+                'col_count': table_structure.get('max_columns', 0)
             }
 
         except Exception as e:
@@ -147,53 +175,70 @@ class TableExtractor:
         ocr_result = result[0]
 
         # 收集所有文本和位置信息
-        cells = []
-        for line in ocr_result:
-            if len(line) >= 2:
-                text = line[1][0]
-                points = line[0]
-
-                # 计算边界框
-                x_coords = [p[0] for p in points]
-                y_coords = [p[1] for p in points]
-
-                cells.append({
-                    'text': text.strip(),
-                    'bbox': {
-                        'x_min': min(x_coords),
-                        'x_max': max(x_coords),
-                        'y_min': min(y_coords),
-                        'y_max': max(y_coords)
-                    },
-                    'center': {
-                        'x': np.mean(x_coords),
-                        'y': np.mean(y_coords)
-                    }
-                })
+        lines = [line for line in ocr_result if len(line) >= 2]
+        if not lines:
+            return [], {}
 
-        # 按行聚类
-        cells.sort(key=lambda x: x['center']['y'])
+        # 计算边界框和中心点，每项形状为 (N, 2)
+        mins = np.empty((len(lines), 2), dtype=np.float32)
+        maxs = np.empty((len(lines), 2), dtype=np.float32)
+        centers = np.empty((len(lines), 2), dtype=np.float32)
+
+        # 四点框（绝大多数）堆叠为 (M, 4, 2) 批量计算
+        quad_idx = [i for i, line in enumerate(lines) if len(line[0]) == 4]
+        if quad_idx:
+            quads = np.asarray([lines[i][0] for i in quad_idx], dtype=np.float32)
+            mins[quad_idx] = quads.min(axis=1)
+            maxs[quad_idx] = quads.max(axis=1)
+            centers[quad_idx] = quads.mean(axis=1)
+
+        # 其他点数的多边形逐个计算
+        for i, line in enumerate(lines):
+            if len(line[0]) != 4:
+                polygon = np.asarray(line[0], dtype=np.float32).reshape(-1, 2)
+                mins[i] = polygon.min(axis=0)
+                maxs[i] = polygon.max(axis=0)
+                centers[i] = polygon.mean(axis=0)
+
+        # 按中心点 y 坐标排序
+        order = np.argsort(centers[:, 1], kind='stable')
+
+        cells = [
+            {
+                'text': lines[i][1][0].strip(),
+                'bbox': {
+                    'x_min': x_min,
+                    'x_max': x_max,
+                    'y_min': y_min,
+                    'y_max': y_max
+                },
+                'center': {
+                    'x': cx,
+                    'y': cy
+                }
+            }
+            for i, (x_min, y_min), (x_max, y_max), (cx, cy) in zip(
+                order.tolist(),
+                mins[order].tolist(),
+                maxs[order].tolist(),
+                centers[order].tolist()
+            )
+        ]
 
-        # 行聚类阈值
+        # 按行聚类：相邻中心点 y 坐标之差大于等于阈值处即为行分隔。
+        # 注意只比较相邻单元格，间距逐个都小于阈值的单元格会连成同一行，
+        # 即使整行的 y 跨度超过阈值（旧实现与行首单元格比较，会在此处分行）
         row_threshold = 20
-        rows = []
-        current_row = []
+        sorted_centers = centers[order]
+        is_break = np.diff(sorted_centers[:, 1]) >= row_threshold
+        breaks = np.flatnonzero(is_break) + 1
+        row_ids = np.concatenate(([0], np.cumsum(is_break)))
 
-        for i, cell in enumerate(cells):
-            if i == 0:
-                current_row.append(cell)
-            else:
-                if abs(cell['center']['y'] - current_row[0]['center']['y']) < row_threshold:
-                    current_row.append(cell)
-                else:
-                    # 行内按 x 坐标排序
-                    current_row.sort(key=lambda x: x['center']['x'])
-                    rows.append(current_row)
-                    current_row = [cell]
-
-        if current_row:
-            current_row.sort(key=lambda x: x['center']['x'])
-            rows.append(current_row)
+        # 一次排序完成所有行的行内排序：先按行号，再按 x 坐标
+        cell_order = np.lexsort((sorted_centers[:, 0], row_ids))
+        ordered_cells = [cells[k] for k in cell_order.tolist()]
+        bounds = [0, *breaks.tolist(), len(ordered_cells)]
+        rows = [ordered_cells[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
 
         # 构建表格数据
         table_data = []
@@ -223,17 +268,9 @@ class TableExtractor:
             Excel 文件路径
         """
         try:
-            # 创建 DataFrame
             if not table_data:
                 raise ValueError("表格数据为空")
 
-            # 确保所有行有相同的列数
-            max_cols = max(len(row) for row in table_data)
-            for row in table_data:
-                row.extend([''] * (max_cols - len(row)))
-
-            df = pd.DataFrame(table_data)
-
             # 生成 Excel 文件路径
             excel_dir = os.path.join(os.path.dirname(original_path), 'outputs')
             os.makedirs(excel_dir, exist_ok=True)
@@ -241,8 +278,22 @@ class TableExtractor:
             excel_filename = os.path.basename(original_path).rsplit('.', 1)[0] + '.xlsx'
             excel_path = os.path.join(excel_dir, excel_filename)
 
-            # 保存为 Excel
-            df.to_excel(excel_path, index=False, header=False)
+            # 逐行流式写入 Excel，内存占用只与单行大小有关；
+            # 短行末尾缺失的单元格在 Excel 中即为空白，无需补齐
+            # 使用 1 MiB 缓冲区合并 ZIP 打包时的大量小块写入
+            with open(excel_path, 'wb', buffering=EXCEL_WRITE_BUFFER_SIZE) as excel_file:
+                workbook = xlsxwriter.Workbook(excel_file, {
+                    'constant_memory': True,
+                    # 保持 OCR 文本原样，不转换为超链接或数字
+                    'strings_to_urls': False,
+                    'strings_to_numbers': False
+                })
+                try:
+                    worksheet = workbook.add_worksheet()
+                    for row_idx, row in enumerate(table_data):
+                        worksheet.write_row(row_idx, 0, row)
+                finally:
+                    workbook.close()
             logger.info(f"Excel 文件已保存: {excel_path}")
 
             return excel_path
@@ -251,7 +302,8 @@ class TableExtractor:
             logger.error(f"保存 Excel 文件失败: {e}")
             raise
 
-    def validate_image(self, image_path: str) -> bool:
+    @staticmethod
+    def validate_image(image_path: str) -> bool:
         """
         验证图像是否适合表格识别
 
@@ -262,27 +314,39 @@ class TableExtractor:
             是否有效
         """
         try:
-            img = cv2.imread(image_path)
-            if img is None:
-                return False
-
-            # 检查图像尺寸
-            height, width = img.shape[:2]
+            # 检查图像尺寸（只读取文件头，不解码像素）
+            with Image.open(image_path) as im:
+                width, height = im.size
             if height < 100 or width < 100:
                 return False
 
-            # 检查图像是否太模糊
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
+            # 检查图像是否太模糊：统一缩小到长边不超过 BLUR_CHECK_SIZE 再计算，
+            # 解码时选择不低于工作尺寸的最大缩小倍数，减少解码量
+            long_edge = max(height, width)
+            flag = cv2.IMREAD_GRAYSCALE
+            for factor, reduced_flag in REDUCED_GRAYSCALE_FLAGS:
+                if long_edge // factor >= BLUR_CHECK_SIZE:
+                    flag = reduced_flag
+                    break
+
+            gray = cv2.imread(image_path, flag)
+            if gray is None:
+                return False
 
-            if laplacian_var < 100:  # 模糊度阈值
+            scale = BLUR_CHECK_SIZE / max(gray.shape[:2])
+            if scale < 1:
+                gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            laplacian_var = cv2.Laplacian(gray, cv2.CV_32F).var()
+
+            # 拉普拉斯方差与尺度有关，图像缩小后方差变大，因此按缩小倍数 f 将阈值换算为
+            # 100 * f^2；不大于工作尺寸的图像阈值仍为 100。
+            # 清晰图像缩小后方差只增大约 f 倍，因此 f 最多按 BLUR_MAX_SHRINK 计算，
+            # 避免超大的清晰图像（如手机照片）被误判为模糊
+            shrink = min(long_edge / max(gray.shape[:2]), BLUR_MAX_SHRINK)
+            if laplacian_var < BLUR_THRESHOLD * shrink ** 2:
                 return False
 
             return True
 
         except Exception:
             return False
-
-
-# 全局实例
-extractor = TableExtractor(use_gpu=False)
\ No newline at end of file